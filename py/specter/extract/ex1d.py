@@ -14,11 +14,10 @@ import sys
 import os
 import numpy as np
 import math
-
-from specter.util import gausspix, weighted_solve
+import numba
 
 def ex1d(img, mask, psf, readnoise=2.5, specrange=None, yrange=None,
-         nspec_per_group=20, debug=False, model=False):
+         nspec_per_group=20, debug=False, model=False, verbose=False):
     """Extract spectra from an image using row-by-row weighted extraction.
 
     Parameters
@@ -41,15 +40,18 @@ def ex1d(img, mask, psf, readnoise=2.5, specrange=None, yrange=None,
         Extract spectra in groups of N spectra (faster if spectra are physically
         separated into non-overlapping groups).
     debug : bool, optional
-        If ``True``, stop with prompt after each row
+        If ``True``, stop with prompt after each group of spectra
     model : bool, optional
-        Unknown parameter
+        If ``True``, also return the model image
+    verbose : bool, optional
+        If ``True``, print progress for each group of spectra
 
     Returns
     -------
     tuple
         Tuple containing spectra[nspec, ny] the extracted spectra,
-        specivar[nspec, ny] the inverse variance of spectra.
+        specivar[nspec, ny] the inverse variance of spectra, and
+        the model image if `model` is ``True``.
     """
 
     #- Range of spectra to extract
@@ -59,8 +61,10 @@ def ex1d(img, mask, psf, readnoise=2.5, specrange=None, yrange=None,
     #- Rows to extract
     ymin, ymax = yrange if (yrange is not None) else (0, psf.npix_y)
     ny = ymax - ymin
-    nx = img.shape[0]
-    xx = np.arange(nx)
+
+    #- contiguous float64 copies (if needed) for the jit-compiled row solver
+    img = np.ascontiguousarray(img, dtype=np.float64)
+    mask = np.ascontiguousarray(mask)
 
     spectra = np.zeros((nspec, ny))
     specivar = np.zeros((nspec, ny))
@@ -71,6 +75,8 @@ def ex1d(img, mask, psf, readnoise=2.5, specrange=None, yrange=None,
     #- Loop over groups of spectra
     for speclo in range(specmin, specmax, nspec_per_group):
         spechi = min(specmax, speclo+nspec_per_group)
+        if verbose:
+            print("Rows {}:{} spectra {}:{}".format(ymin, ymax, speclo, spechi))
 
         #- Calc trace centers (x0) and gaussian sigmas (xsigma) for each row
         allx0 = np.zeros((nspec_per_group, ymax-ymin))
@@ -81,63 +87,151 @@ def ex1d(img, mask, psf, readnoise=2.5, specrange=None, yrange=None,
             allx0[ispec-speclo] = psf.x(ispec, w)
             allxsigma[ispec-speclo] = psf.xsigma(ispec, w)
 
-        #- Loop over CCD rows
-        for irow, row in enumerate(range(ymin, ymax)):
-            if debug and row%500 == 0:
-                print("Row {:3d} spectra {}:{}".format(row, speclo, spechi))
-
-            #- Determine x range covered for this row of this group of spectra
-            wlo = psf.wavelength(speclo, y=row)
-            whi = psf.wavelength(spechi-1, y=row)
-            if speclo == 0:
-                xmin = 0
-            else:
-                xmin = int(0.5*(psf.x(speclo-1, wlo) + psf.x(speclo, wlo)))
-
-            if spechi >= psf.nspec:
-                xmax = psf.npix_x
-            else:
-                xmax = int(0.5*(psf.x(spechi-1, wlo) + psf.x(spechi, wlo)) + 1)
-
-            #- Design matrix for pixels = A * flux for this row
-            A = np.zeros( (xmax-xmin, spechi-speclo) )
-            for ispec in range(speclo, spechi):
-                # w = psf.wavelength(ispec, y=row)
-                # x0 = psf.x(ispec, w)
-                # xsigma = psf.xsigma(ispec, w)
-                x0 = allx0[ispec-speclo, irow]
-                xsigma = allxsigma[ispec-speclo, irow]
-
-                #- x range for single spectrum on single row
-                xlo = max(xmin, int(x0-5*xsigma))
-                xhi = min(xmax, int(x0+5*xsigma+1))
-
-                A[xlo-xmin:xhi-xmin, ispec-speclo] = gausspix(xx[xlo:xhi], x0, xsigma)
-
-            #- Original solve, weighting by input ivar
-            ### tmpspec, iCov = weighted_solve(A, img[row, xmin:xmax], ivar[row, xmin:xmax])
-
-            #- Solve weighting only by readnoise and mask
-            nx = xmax-xmin
-            xvar = np.ones(nx)*readnoise**2 * (mask[row, xmin:xmax] == 0)
-            tmpspec, iCov = weighted_solve(A, img[row, xmin:xmax], 1.0/xvar)
-
-            #- Re-extract with weight incluing model shot noise
-            xvar = (A.dot(tmpspec) + readnoise**2) * (mask[row, xmin:xmax] == 0)
-            tmpspec, iCov = weighted_solve(A, img[row, xmin:xmax], 1.0/xvar)
-
-            if model:
-                imgmodel[row, xmin:xmax] = A.dot(tmpspec)
-
-            spectra[speclo-specmin:spechi-specmin, row-ymin] = tmpspec
-            specivar[speclo-specmin:spechi-specmin, row-ymin] = iCov.diagonal()
-
-            if debug:
-                print(speclo, row)
-                import IPython
-                IPython.embed()
+        #- Determine x range covered for each row of this group of spectra,
+        #- using the wavelengths of the first spectrum on each row
+        wlo = psf.wavelength(speclo, y=rows)
+        if speclo == 0:
+            xmin = np.zeros(ymax-ymin, dtype=int)
+        else:
+            xmin = (0.5*(psf.x(speclo-1, wlo) + allx0[0])).astype(int)
+
+        if spechi >= psf.nspec:
+            xmax = np.full(ymax-ymin, psf.npix_x, dtype=int)
+        else:
+            xmax = (0.5*(psf.x(spechi-1, wlo) + psf.x(spechi, wlo)) + 1).astype(int)
+
+        #- Extract every row of this group of spectra
+        tmpspec, tmpivar = _ex1d_rows(img, mask, allx0[0:spechi-speclo],
+            allxsigma[0:spechi-speclo], xmin, xmax, ymin, readnoise,
+            imgmodel if model else None)
+
+        spectra[speclo-specmin:spechi-specmin] = tmpspec
+        specivar[speclo-specmin:spechi-specmin] = tmpivar
+
+        if debug:
+            print(speclo, spechi)
+            import IPython
+            IPython.embed()
 
     if model:
         return spectra, specivar, imgmodel
     else:
         return spectra, specivar
+
+
+@numba.jit(nopython=True, cache=False)
+def _weighted_solve(A, b, w):
+    """
+    Solve `A x = b` with weights `w` on `b`; see specter.util.weighted_solve.
+    Returns x, inverseCovarance(x)
+    """
+    AtW = A.T * w
+    iCov = AtW.dot(A)
+    y = AtW.dot(b)
+    x, ok = _cholesky_solve(iCov, y)
+    if not ok:
+        #- not positive definite, e.g. a spectrum with no unmasked pixels
+        x = np.linalg.lstsq(iCov, y, rcond=-1.0)[0]
+    return x, iCov
+
+@numba.jit(nopython=True, cache=False)
+def _cholesky_solve(M, y):
+    """
+    Solve `M x = y` for small symmetric positive definite M.
+    Returns x, ok where ok is False if M is not positive definite.
+    """
+    n = M.shape[0]
+    L = np.zeros((n, n))
+    x = np.zeros(n)
+    #- M = L L.T
+    for j in range(n):
+        d = M[j, j]
+        for k in range(j):
+            d -= L[j, k]*L[j, k]
+        if not d > 0.0:
+            return x, False
+        L[j, j] = math.sqrt(d)
+        for i in range(j+1, n):
+            s = M[i, j]
+            for k in range(j):
+                s -= L[i, k]*L[j, k]
+            L[i, j] = s / L[j, j]
+
+    #- forward substitution L z = y, then back substitution L.T x = z
+    for i in range(n):
+        s = y[i]
+        for k in range(i):
+            s -= L[i, k]*x[k]
+        x[i] = s / L[i, i]
+    for i in range(n-1, -1, -1):
+        s = x[i]
+        for k in range(i+1, n):
+            s -= L[k, i]*x[k]
+        x[i] = s / L[i, i]
+
+    return x, True
+
+@numba.jit(nopython=True, cache=False)
+def _ex1d_rows(img, mask, x0, xsigma, xmin, xmax, ymin, readnoise, imgmodel):
+    """
+    Row-by-row extraction of a group of spectra, for use by ex1d.
+
+    Args:
+        img : 2D CCD image
+        mask : 2D image mask, 0=good, non-zero=bad
+        x0[nspec, ny] : trace centers for each spectrum and row
+        xsigma[nspec, ny] : gaussian cross-dispersion sigmas
+        xmin[ny], xmax[ny] : x range covered by the spectra on each row
+        ymin : CCD row corresponding to index 0 of x0, xsigma, xmin, xmax
+        readnoise : CCD readnoise
+        imgmodel : 2D image to fill with the model, or None
+
+    Returns (spectra, specivar):
+        spectra[nspec, ny] : extracted spectra
+        specivar[nspec, ny] : inverse variance of spectra
+    """
+    nspec, ny = x0.shape
+    spectra = np.zeros((nspec, ny))
+    specivar = np.zeros((nspec, ny))
+    sqrt2 = math.sqrt(2.0)
+
+    for irow in range(ny):
+        row = ymin + irow
+        lo = xmin[irow]
+        hi = xmax[irow]
+        nx = hi - lo
+
+        #- Design matrix for pixels = A * flux for this row;
+        #- Gaussian integrated over unit width pixels, as in gausspix
+        A = np.zeros((nx, nspec))
+        for i in range(nspec):
+            xc = x0[i, irow]
+            sigma = sqrt2 * xsigma[i, irow]
+
+            #- x range for single spectrum on single row
+            xlo = max(lo, int(xc-5*xsigma[i, irow]))
+            xhi = min(hi, int(xc+5*xsigma[i, irow]+1))
+            for x in range(xlo, xhi):
+                A[x-lo, i] = 0.5*(math.erf((x+0.5-xc)/sigma) - math.erf((x-0.5-xc)/sigma))
+
+        pix = img[row, lo:hi]
+        good = np.zeros(nx)
+        for j in range(nx):
+            if mask[row, lo+j] == 0:
+                good[j] = 1.0
+
+        #- Solve weighting only by readnoise and mask
+        xvar = readnoise**2 * good
+        flux, iCov = _weighted_solve(A, pix, 1.0/xvar)
+
+        #- Re-extract with weight incluing model shot noise
+        xvar = (A.dot(flux) + readnoise**2) * good
+        flux, iCov = _weighted_solve(A, pix, 1.0/xvar)
+
+        if imgmodel is not None:
+            imgmodel[row, lo:hi] = A.dot(flux)
+
+        spectra[:, irow] = flux
+        specivar[:, irow] = np.diag(iCov)
+
+    return spectra, specivar
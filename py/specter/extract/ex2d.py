@@ -11,14 +11,13 @@ import numpy as np
 import scipy.sparse
 import scipy.linalg
 from scipy.sparse import spdiags, issparse
-from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import spsolve, cg, minres
 
-from specter.util import outer
 
 def ex2d(image, imageivar, psf, specmin, nspec, wavelengths, xyrange=None,
          regularize=0.0, ndecorr=False, bundlesize=25, nsubbundles=1,
          wavesize=50, full_output=False, verbose=False,
-         debug=False, psferr=None):
+         debug=False, psferr=None, dtype=np.float64, method='eigh'):
     '''2D PSF extraction of flux from image patch given pixel inverse variance.
 
     Parameters
@@ -62,6 +61,13 @@ def ex2d(image, imageivar, psf, specmin, nspec, wavelengths, xyrange=None,
         fractional error on the psf model instead of the value saved
         in the psf fits file. This is used only to compute the chi2,
         not to weight pixels in fit
+    dtype : numpy dtype, optional
+        floating point precision of the per-patch linear algebra;
+        see ex2d_patch.  Outputs are always float64.  With
+        method='cholesky' the factorization is always float64.
+    method : str, optional
+        'eigh' (default) or 'cholesky' decomposition of the inverse
+        covariance for the resolution matrix; see resolution_from_icov.
 
     Returns
     -------
@@ -99,9 +105,9 @@ def ex2d(image, imageivar, psf, specmin, nspec, wavelengths, xyrange=None,
     #- Keep resolution matrix terms equivalent to 9-sigma of largest spot
     #- ndiag is in units of number of wavelength steps of size dw
     ndiag = 0
+    wcheck = np.array([psf.wmin, 0.5*(psf.wmin+psf.wmax), psf.wmax])
     for ispec in [specmin, specmin+nspec//2, specmin+nspec-1]:
-        for w in [psf.wmin, 0.5*(psf.wmin+psf.wmax), psf.wmax]:
-            ndiag = max(ndiag, int(round(9.0*psf.wdisp(ispec, w) / dw )))
+        ndiag = max(ndiag, int(round(9.0*np.max(psf.wdisp(ispec, wcheck)) / dw )))
 
     #- make sure that ndiag isn't too large for actual PSF spot size
     wmid = (psf.wmin_all + psf.wmax_all) / 2.0
@@ -114,6 +120,12 @@ def ex2d(image, imageivar, psf, specmin, nspec, wavelengths, xyrange=None,
     if psferr is None :
         psferr = psf.psferr
 
+    #+ TODO: what should this do to R in the case of non-uniform bins?
+    #+       maybe should do everything in photons/A from the start.
+    #- Outputs are converted to photons/A instead of photons/bin as
+    #- each patch is filled in
+    dwave = np.gradient(wavelengths)
+
     #- Let's do some extractions
     for bundlelo in range(specmin, specmin+nspec, bundlesize):
         #- index of last spectrum, non-inclusive, i.e. python-style indexing
@@ -129,6 +141,12 @@ def ex2d(image, imageivar, psf, specmin, nspec, wavelengths, xyrange=None,
 
             specrange = (speclo, spechi)
 
+            #- Output rows of the kept spectra; the same for every
+            #- wavelength patch of this subbundle
+            ## iispec = slice(speclo-specmin, spechi-specmin)
+            iispec = np.arange(speclo-specmin, spechi-specmin)
+            iikeep = iispec[keep]
+
             for iwave in range(0, len(wavelengths), wavesize):
                 #- Low and High wavelengths for the core region
                 wlo = wavelengths[iwave]
@@ -170,7 +188,7 @@ def ex2d(image, imageivar, psf, specmin, nspec, wavelengths, xyrange=None,
                     ex2d_patch(subimg, subivar, psf,
                         specmin=speclo, nspec=spechi-speclo, wavelengths=ww,
                         xyrange=[xlo,xhi,ylo,yhi], regularize=regularize, ndecorr=ndecorr,
-                        full_output=True, use_cache=True)
+                        full_output=True, use_cache=True, dtype=dtype, method=method)
 
                 specflux = results['flux']
                 specivar = results['ivar']
@@ -188,14 +206,14 @@ def ex2d(image, imageivar, psf, specmin, nspec, wavelengths, xyrange=None,
                     flux[ii] = 0.0
                     ivar[ii] = 0.0
 
-                #- Fill in the final output arrays
-                ## iispec = slice(speclo-specmin, spechi-specmin)
-                iispec = np.arange(speclo-specmin, spechi-specmin)
-                flux[iispec[keep], iwave:iwave+wavesize+1] = specflux[keep, nlo:-nhi]
-                ivar[iispec[keep], iwave:iwave+wavesize+1] = specivar[keep, nlo:-nhi]
+                #- Fill in the final output arrays, converting to photons/A
+                dw_core = dwave[iwave:iwave+wavesize+1]
+                flux[iikeep, iwave:iwave+wavesize+1] = specflux[keep, nlo:-nhi] / dw_core
+                ivar[iikeep, iwave:iwave+wavesize+1] = specivar[keep, nlo:-nhi] * dw_core**2
 
                 if full_output:
-                    A = results['A'].copy()
+                    #- A is only read below, so use it without copying
+                    A = results['A']
                     xflux = results['xflux']
 
                     #- Avoid NaN but still propagate into model to mask it too
@@ -210,9 +228,6 @@ def ex2d(image, imageivar, psf, specmin, nspec, wavelengths, xyrange=None,
                     badmodel = np.isnan(submodel)
                     submodel[badmodel] = 0.0
 
-                    #- Fraction of input pixels that are unmasked for each flux bin
-                    subpixmask_fraction = 1.0-(A.T.dot(subivar.ravel()>0)).reshape(subnspec, subnwave)
-
                     #- original weighted chi2 of pixels that contribute to each flux bin
                     # chi = (subimg - submodel) * np.sqrt(subivar)
                     # chi2x = (A.T.dot(chi.ravel()**2) / A.sum(axis=0)).reshape(subnspec, subnwave)
@@ -226,40 +241,57 @@ def ex2d(image, imageivar, psf, specmin, nspec, wavelengths, xyrange=None,
                     totpix_ivar[ii] = 1.0 / (1.0/modelivar[ii] + 1.0/subivar[ii])
 
                     #- Weighted chi2 of pixels that contribute to each flux bin;
-                    #- only use unmasked pixels and avoid dividing by 0
-                    chi = (subimg - submodel) * np.sqrt(totpix_ivar)
-                    psfweight = A.T.dot(totpix_ivar.ravel()>0)
+                    #- only use unmasked pixels and avoid dividing by 0.
+                    #- chi**2 = (subimg - submodel)**2 * totpix_ivar, computed
+                    #- in place without the sqrt or extra temporaries
+                    chi2 = np.subtract(subimg, submodel)
+                    chi2 *= chi2
+                    chi2 *= totpix_ivar
+
+                    #- Project the unmasked input pixels, the pixels used for
+                    #- chi2 (totpix_ivar > 0 exactly where ii is True) and
+                    #- chi2 itself onto the flux bins in a single
+                    #- sparse-dense product, traversing A once
+                    pixterms = np.empty((subimg.size, 3))
+                    pixterms[:, 0] = subivar.ravel() > 0
+                    pixterms[:, 1] = ii.ravel()
+                    pixterms[:, 2] = chi2.ravel()
+                    fluxterms = A.T.dot(pixterms)
+
+                    #- Fraction of input pixels that are unmasked for each flux bin
+                    subpixmask_fraction = 1.0 - fluxterms[:, 0].reshape(subnspec, subnwave)
+
+                    psfweight = fluxterms[:, 1]
                     bad = (psfweight == 0.0)
-                    chi2x = (A.T.dot(chi.ravel()**2) * ~bad) / (psfweight + bad)
+                    chi2x = (fluxterms[:, 2] * ~bad) / (psfweight + bad)
                     chi2x = chi2x.reshape(subnspec, subnwave)
 
                     #- outputs
                     #- TODO: watch out for edge effects on overlapping regions of submodels
                     modelimage[subxy] = submodel
-                    pixmask_fraction[iispec[keep], iwave:iwave+wavesize+1] = subpixmask_fraction[keep, nlo:-nhi]
-                    chi2pix[iispec[keep], iwave:iwave+wavesize+1] = chi2x[keep, nlo:-nhi]
-
-                #- Fill diagonals of resolution matrix
-                for ispec in np.arange(speclo, spechi)[keep]:
-                    #- subregion of R for this spectrum
-                    ii = slice(nw*(ispec-speclo), nw*(ispec-speclo+1))
-                    Rx = R[ii, ii]
-
-                    for j in range(nlo,nw-nhi):
-                        # Rd dimensions [nspec, 2*ndiag+1, nwave]
-                        Rd[ispec-specmin, :, iwave+j-nlo] = Rx[j-ndiag:j+ndiag+1, j]
+                    pixmask_fraction[iikeep, iwave:iwave+wavesize+1] = subpixmask_fraction[keep, nlo:-nhi]
+                    chi2pix[iikeep, iwave:iwave+wavesize+1] = chi2x[keep, nlo:-nhi]
+
+                #- Fill diagonals of resolution matrix, gathering the
+                #- band of each column j of every kept spectrum i in one
+                #- indexing operation:
+                #- band[i, k, j] = Rx[j+k-ndiag, j]
+                #- where Rx = R[nw*i:nw*(i+1), nw*i:nw*(i+1)] is the
+                #- subregion of R for spectrum i, using flat indices into R
+                jj = np.arange(nlo, nw-nhi)
+                rows = jj[None, :] + np.arange(-ndiag, ndiag+1)[:, None]
+                band = rows*R.shape[1] + jj
+                #- flat offsets of the Rx blocks of the kept spectra
+                offset = nw*np.where(keep)[0]*(R.shape[1] + 1)
+
+                # Rd dimensions [nspec, 2*ndiag+1, nwave]
+                Rd[iikeep, :, iwave:iwave+len(jj)] = \
+                    np.take(R, band[None, :, :] + offset[:, None, None])
 
     #- Add extra print because of carriage return \r progress trickery
     if verbose:
         print()
 
-    #+ TODO: what should this do to R in the case of non-uniform bins?
-    #+       maybe should do everything in photons/A from the start.
-    #- Convert flux to photons/A instead of photons/bin
-    dwave = np.gradient(wavelengths)
-    flux /= dwave
-    ivar *= dwave**2
-
     if debug:
         #--- DEBUG ---
         import IPython
@@ -274,7 +306,8 @@ def ex2d(image, imageivar, psf, specmin, nspec, wavelengths, xyrange=None,
 
 
 def ex2d_patch(image, ivar, psf, specmin, nspec, wavelengths, xyrange=None,
-         full_output=False, regularize=0.0, ndecorr=False, use_cache=None):
+         full_output=False, regularize=0.0, ndecorr=False, use_cache=None,
+         dtype=np.float64, method='eigh'):
     """
     2D PSF extraction of flux from image patch given pixel inverse variance.
 
@@ -296,6 +329,18 @@ def ex2d_patch(image, ivar, psf, specmin, nspec, wavelengths, xyrange=None,
 
         use_cache: default behavior, can be turned off for testing purposes
 
+        dtype : floating point precision of the projection matrix,
+            normal equations and (for method='eigh') the Cholesky
+            factorization of the flux solve.  np.float32 halves their
+            memory; the flux solve is refined in float64, the resolution
+            matrix is always computed in float64 and flux, ivar and R are
+            always returned as float64.
+
+        method : 'eigh' (default) or 'cholesky' decomposition of iCov for
+            the resolution matrix; see resolution_from_icov.  With
+            'cholesky' the same dense float64 factorization is also used
+            for the flux, regardless of dtype.
+
     Returns (flux, ivar, R):
         flux[nspec, nwave] = extracted resolution convolved flux
         ivar[nspec, nwave] = inverse variance of flux
@@ -314,9 +359,6 @@ def ex2d_patch(image, ivar, psf, specmin, nspec, wavelengths, xyrange=None,
     else:
         xmin, xmax, ymin, ymax = xyrange
 
-    nx, ny = xmax-xmin, ymax-ymin
-    npix = nx*ny
-
     nspec = specrange[1] - specrange[0]
     nwave = len(wavelengths)
 
@@ -324,10 +366,17 @@ def ex2d_patch(image, ivar, psf, specmin, nspec, wavelengths, xyrange=None,
 
     #- Projection matrix and inverse covariance
     A = psf.projection_matrix(specrange, wavelengths, xyrange, use_cache=use_cache)
+    A = A.astype(dtype, copy=False)
+
+    #- Pixel weights (diagonal of the weights matrix W)
+    w = ivar.ravel().astype(dtype, copy=False)
 
-    #- Pixel weights matrix
-    w = ivar.ravel()
-    W = spdiags(ivar.ravel(), 0, npix, npix)
+    #- Weighted projection matrix W A, shared by the flux weights, the
+    #- inverse covariance A^T (W A) and the weighted data (W A)^T pix.
+    #- W is diagonal, so W A just scales each row of the CSR matrix A
+    WA = scipy.sparse.csr_matrix(
+        (A.data * np.repeat(w, np.diff(A.indptr)), A.indices, A.indptr),
+        shape=A.shape)
 
     #-----
     #- Extend A with an optional regularization term to limit ringing.
@@ -338,7 +387,7 @@ def ex2d_patch(image, ivar, psf, specmin, nspec, wavelengths, xyrange=None,
     # ibad = (A.sum(axis=0).A == 0)[0]
 
     #- Identify fluxes with very low weights of pixels contributing
-    fluxweight = W.dot(A).sum(axis=0).A[0]
+    fluxweight = WA.sum(axis=0).A[0]
 
     # The following minweight is a regularization term needed to avoid ringing due to
     # a flux bias on the edge flux bins in the
@@ -357,37 +406,59 @@ def ex2d_patch(image, ivar, psf, specmin, nspec, wavelengths, xyrange=None,
     # I.data[0,ibad] = minweight - fluxweight[ibad]
 
     #- Add regularization of low weight fluxes
-    Idiag = regularize*np.ones(nspec*nwave)
+    Idiag = regularize*np.ones(nspec*nwave, dtype=dtype)
     Idiag[ibad] = minweight - fluxweight[ibad]
-    I = scipy.sparse.identity(nspec*nwave)
-    I.setdiag(Idiag)
-
-    #- Only need to extend A if regularization is non-zero
-    if np.any(I.diagonal()):
-        pix = np.concatenate( (image.ravel(), np.zeros(nspec*nwave)) )
-        Ax = scipy.sparse.vstack( (A, I) )
-        wx = np.concatenate( (w, np.ones(nspec*nwave)) )
-    else:
-        pix = image.ravel()
-        Ax = A
-        wx = w
+
+    pix = image.ravel().astype(dtype, copy=False)
 
     #- Inverse covariance
-    Wx = spdiags(wx, 0, len(wx), len(wx))
-    iCov = Ax.T.dot(Wx.dot(Ax))
+    #- A^T W A is only ~nspec*nwave square and fills in to nearly dense,
+    #- so build it with sparse products but keep it dense from here on
+    #- for the dense Cholesky solve and eigendecomposition below
+    iCov = A.T.dot(WA).toarray()
+
+    #- The regularization is equivalent to extending A with the rows
+    #- diag(Idiag), with unit weight and zero pixel values.  That adds
+    #- diag(Idiag**2) to A^T W A and nothing to A^T W pix, so add it
+    #- directly instead of stacking the extra rows onto A
+    iCov[np.diag_indices_from(iCov)] += Idiag**2
 
     #- if everything was masked, create diagonal iCov so that that the
     #- math below can proceed as-is, but flag final data as ivar=0
     all_input_masked = False
-    if np.all(w == 0.0) or (iCov.nnz == 0):
-        iCov = scipy.sparse.csr_matrix(1e-8*scipy.sparse.identity(nspec*nwave))
+    if np.all(w == 0.0) or not np.any(iCov):
+        iCov = 1e-8*np.eye(nspec*nwave, dtype=dtype)
         all_input_masked = True
 
-    #- Solve (image = A flux) weighted by Wx:
+    #- Solve (image = A flux) weighted by W:
     #-     A^T W image = (A^T W A) flux = iCov flux
-    y = Ax.T.dot(Wx.dot(pix))
-
-    xflux = spsolve(iCov, y).reshape((nspec, nwave))
+    y = WA.T.dot(pix)
+
+    #- The eigendecomposition for the resolution matrix resolves the
+    #- weakly constrained border flux bins only in float64, so promote
+    #- iCov and y back to float64 from here on
+    iCov = iCov.astype(np.float64, copy=False)
+    y = y.astype(np.float64, copy=False)
+
+    #- With method='cholesky' the resolution matrix needs the dense upper
+    #- Cholesky factor of iCov anyway, so factor once and also use it to
+    #- solve for the flux; fall back to eigh if iCov isn't positive definite
+    U = None
+    if method == 'cholesky':
+        try:
+            U = scipy.linalg.cholesky(iCov, lower=False)
+        except np.linalg.LinAlgError:
+            method = 'eigh'
+
+    if U is not None:
+        xflux = scipy.linalg.cho_solve((U, False), y).reshape((nspec, nwave))
+    else:
+        #- iCov is small and symmetric positive definite (regularized above),
+        #- so a dense Cholesky solve is much faster than a sparse LU solve.
+        #- The Cholesky factorization is done in the working precision dtype
+        #- and refined against the float64 iCov if that is lower precision.
+        #- The same dense iCov is reused below for the resolution matrix.
+        xflux = _solve_icov(iCov, y, factor_dtype=dtype).reshape((nspec, nwave))
 
     #- TODO: could check for outliers, remask and re-extract
     #- Be careful in case masking blocks off all inputs to a flux bin and
@@ -400,9 +471,10 @@ def ex2d_patch(image, ivar, psf, specmin, nspec, wavelengths, xyrange=None,
     #- Solve for Resolution matrix
     try:
         if ndecorr:
-            R, fluxivar = resolution_from_icov(iCov)
+            R, fluxivar = resolution_from_icov(iCov, method=method, cholesky_factor=U)
         else:
-            R, fluxivar = resolution_from_icov(iCov, decorr=[nwave for x in range(nspec)])
+            R, fluxivar = resolution_from_icov(iCov, decorr=[nwave for x in range(nspec)],
+                method=method, cholesky_factor=U)
     except np.linalg.linalg.LinAlgError as err:
         outfile = 'LinAlgError_{}-{}_{}-{}.fits'.format(specrange[0], specrange[1], waverange[0], waverange[1])
         print("ERROR: Linear Algebra didn't converge")
@@ -413,7 +485,7 @@ def ex2d_patch(image, ivar, psf, specmin, nspec, wavelengths, xyrange=None,
         fits.append(outfile, A.data, name='ADATA')
         fits.append(outfile, A.indices, name='AINDICES')
         fits.append(outfile, A.indptr, name='AINDPTR')
-        fits.append(outfile, iCov.toarray(), name='ICOV')
+        fits.append(outfile, iCov, name='ICOV')
         raise err
 
     #- Convolve with Resolution matrix to decorrelate errors
@@ -432,13 +504,138 @@ def ex2d_patch(image, ivar, psf, specmin, nspec, wavelengths, xyrange=None,
         results = dict(flux=rflux, ivar=fluxivar, R=R, xflux=xflux, A=A, iCov=iCov)
         results['options'] = dict(
             specmin=specmin, nspec=nspec, wavelengths=wavelengths,
-            xyrange=xyrange, regularize=regularize, ndecorr=ndecorr
-            )
+            xyrange=xyrange, regularize=regularize, ndecorr=ndecorr,
+            dtype=dtype, method=method)
         return results
     else:
         return rflux, fluxivar, R
 
 
+def _solve_icov(iCov, y, factor_dtype=None, nrefine=2):
+    """
+    Solve iCov x = y for dense symmetric positive definite iCov
+
+    Uses a Cholesky factorization, banded if iCov has a narrow band (see
+    _cholesky_solver).  If iCov turns out not to be positive
+    definite to machine precision, falls back to Jacobi preconditioned
+    conjugate gradients, then to MINRES (which also handles symmetric
+    indefinite matrices), and finally to a general sparse solver.
+
+    If factor_dtype is lower precision than iCov (e.g. np.float32), the
+    Cholesky factorization is done in factor_dtype and the solution is
+    improved with nrefine steps of iterative refinement in the precision
+    of iCov (mixed precision).
+    """
+    if factor_dtype is None:
+        factor_dtype = iCov.dtype
+
+    try:
+        cho_solve = _cholesky_solver(iCov, factor_dtype)
+        x = cho_solve(y)
+        if np.dtype(factor_dtype) != iCov.dtype:
+            x = x.astype(iCov.dtype)
+            for i in range(nrefine):
+                x += cho_solve(y - iCov.dot(x))
+        return x
+    except np.linalg.LinAlgError:
+        pass
+
+    #- Jacobi preconditioner; guard against non-positive diagonal terms
+    d = np.diagonal(iCov)
+    d = np.where(d > 0, d, 1.0)
+    M = scipy.sparse.diags(1.0/d)
+    x, info = _iterative_solve(cg, iCov, y, M=M, maxiter=len(y))
+    if info == 0:
+        return x
+
+    #- CG stalled; warm start MINRES from where it got to
+    x, info = _iterative_solve(minres, iCov, y, x0=x, M=M, maxiter=len(y))
+    if info == 0:
+        return x
+
+    return spsolve(scipy.sparse.csr_matrix(iCov), y)
+
+def _iterative_solve(solver, A, y, rtol=1e-10, **kwargs):
+    """
+    Call scipy.sparse.linalg iterative solver(A, y, **kwargs) with relative
+    tolerance rtol, which is called tol in SciPy < 1.12
+    """
+    try:
+        return solver(A, y, rtol=rtol, **kwargs)
+    except TypeError:
+        return solver(A, y, tol=rtol, **kwargs)
+
+def _cholesky_solver(iCov, dtype):
+    """
+    Cholesky factorize iCov in precision dtype
+
+    Returns a function that solves iCov x = y given y.  Flux bins only
+    couple to nearby wavelengths of the same and neighboring spectra, so
+    when the bandwidth of iCov is less than half its size a banded
+    factorization (O(n b^2) instead of O(n^3)) is used.
+
+    Raises np.linalg.LinAlgError if iCov is not positive definite.
+    """
+    n = iCov.shape[0]
+
+    #- bandwidth = outermost nonzero upper diagonal; scanning diagonal views
+    #- avoids allocating O(n^2) index arrays
+    bandwidth = n - 1
+    while bandwidth > 0 and not np.any(np.diagonal(iCov, bandwidth)):
+        bandwidth -= 1
+
+    if 2*bandwidth < n:
+        #- upper form banded storage: ab[bandwidth + i - j, j] = iCov[i, j]
+        ab = np.zeros((bandwidth+1, n), dtype=dtype)
+        for k in range(bandwidth+1):
+            ab[bandwidth-k, k:] = np.diagonal(iCov, k)
+        cb = scipy.linalg.cholesky_banded(ab, overwrite_ab=True, lower=False)
+        return lambda y: scipy.linalg.cho_solve_banded((cb, False), y.astype(dtype, copy=False))
+    else:
+        cho = scipy.linalg.cho_factor(iCov.astype(dtype), overwrite_a=True)
+        return lambda y: scipy.linalg.cho_solve(cho, y.astype(dtype, copy=False))
+
+def _regularize_eigenvalues(w, invert=False, sqr=False):
+    """
+    Regularize eigenvalues for recomposing a matrix with eigen_compose.
+
+    Optionally take the square root of the eigenvalues and / or invert
+    the eigenvalues.  The eigenvalues are regularized such that the
+    condition number remains within machine precision for the floating
+    point type of w.
+
+    Arguments:
+        w (array): 1D array of eigenvalues
+        invert (bool): Should the eigenvalues be inverted? (False)
+        sqr (bool): Should the square root eigenvalues be used? (False)
+
+    Returns:
+        1D array of regularized eigenvalues
+    """
+    # Threshold is 10 times the machine precision (~1e-15 for float64)
+    threshold = 10.0 * np.finfo(w.dtype).eps
+
+    maxval = np.max(w)
+
+    if sqr:
+        minval = np.sqrt(maxval) * threshold
+        wx = np.sqrt(w)
+        #- NOTE: the non-inverted square root has always compared the
+        #- eigenvalues themselves (not their square roots) to minval
+        good = (wx > minval) if invert else (w > minval)
+    else:
+        minval = maxval * threshold
+        wx = w
+        good = (w > minval)
+
+    #- Clip eigenvalues at minval; when inverting, the clipping also
+    #- avoids dividing by (nearly) zero eigenvalues
+    wscaled = np.where(good, wx, minval)
+    if invert:
+        wscaled = 1.0 / wscaled
+
+    return wscaled
+
 def eigen_compose(w, v, invert=False, sqr=False):
     """
     Create a matrix from its eigenvectors and eigenvalues.
@@ -459,57 +656,13 @@ def eigen_compose(w, v, invert=False, sqr=False):
     Returns:
         A 2D numpy array which is the recomposed matrix.
     """
-    dim = w.shape[0]
-
-    # Threshold is 10 times the machine precision (~1e-15)
-    threshold = 10.0 * sys.float_info.epsilon
-
-    maxval = np.max(w)
-    wscaled = np.zeros_like(w)
-
-    if invert:
-        # Normally, one should avoid explicit loops in python.
-        # in this case however, we need to conditionally invert
-        # the eigenvalues only if they are above the threshold.
-        # Otherwise we might divide by zero.  Since the number
-        # of eigenvalues is never too large, this should be fine.
-        # If it does impact performance, we can improve this in
-        # the future.  NOTE: simple timing with an average over
-        # 10 loops shows that all four permutations of invert and
-        # sqr options take about the same time- so this is not
-        # an issue.
-        if sqr:
-            minval = np.sqrt(maxval) * threshold
-            replace = 1.0 / minval
-            tempsqr = np.sqrt(w)
-            for i in range(dim):
-                if tempsqr[i] > minval:
-                    wscaled[i] = 1.0 / tempsqr[i]
-                else:
-                    wscaled[i] = replace
-        else:
-            minval = maxval * threshold
-            replace = 1.0 / minval
-            for i in range(dim):
-                if w[i] > minval:
-                    wscaled[i] = 1.0 / w[i]
-                else:
-                    wscaled[i] = replace
-    else:
-        if sqr:
-            minval = np.sqrt(maxval) * threshold
-            replace = minval
-            wscaled[:] = np.where((w > minval), np.sqrt(w), replace*np.ones_like(w))
-        else:
-            minval = maxval * threshold
-            replace = minval
-            wscaled[:] = np.where((w > minval), w, replace*np.ones_like(w))
+    wscaled = _regularize_eigenvalues(w, invert=invert, sqr=sqr)
 
-    # multiply to get result
-    wdiag = spdiags(wscaled, 0, dim, dim)
-    return v.dot( wdiag.dot(v.T) )
+    # multiply to get result; scaling the columns of v is the same
+    # as v.dot(diag(wscaled)) without the extra matrix product
+    return (v * wscaled).dot(v.T)
 
-def resolution_from_icov(icov, decorr=None):
+def resolution_from_icov(icov, decorr=None, method='eigh', cholesky_factor=None):
     """
     Function to generate the 'resolution matrix' in the simplest
     (no unrelated crosstalk) Bolton & Schlegel 2010 sense.
@@ -524,43 +677,104 @@ def resolution_from_icov(icov, decorr=None):
                       noise between fibers (default).  This list should
                       contain the number of elements in each spectrum,
                       which is used to define the size of the blocks.
+        method (str): 'eigh' (default) uses the symmetric square root of
+                      icov as in Bolton & Schlegel 2010; 'cholesky' uses
+                      its upper triangular Cholesky factor instead, which
+                      also decorrelates the noise but yields a one-sided
+                      resolution matrix.  With decorr, 'cholesky' instead
+                      computes the covariance blocks from the inverse
+                      Cholesky factor rather than a full eigh, giving
+                      the same R as 'eigh'.  'cholesky' is about twice as
+                      fast either way.
+        cholesky_factor (array): optional precomputed upper triangular
+                      Cholesky factor U of icov (icov = U.T U) for
+                      method='cholesky'.  It is overwritten.
 
     Returns (R, ivar):
         R : resolution matrix
         ivar : R C R.T  -- decorrelated resolution convolved inverse variance
     """
-    #- force symmetry since due to rounding it might not be exactly symmetric
-    icov = 0.5*(icov + icov.T)
+    if method not in ('eigh', 'cholesky'):
+        raise ValueError("Unknown method {}; should be 'eigh' or 'cholesky'".format(method))
+
+    #- force symmetry since due to rounding it might not be exactly symmetric;
+    #- this also makes icov a private copy that LAPACK may overwrite below.
+    #- Not needed if icov has already been factored.
+    if method != 'cholesky' or cholesky_factor is None:
+        icov = 0.5*(icov + icov.T)
+
+        if issparse(icov):
+            icov = icov.toarray()
+
+    if decorr is not None and np.sum(decorr) != icov.shape[0]:
+        raise RuntimeError("The list of spectral block sizes must sum to the matrix size")
+
+    if method == 'cholesky':
+        #- icov = U.T U, so U plays the role of sqrt_icov in Eqns 10-13:
+        #- U C U.T = I, thus R C R.T is diagonal for R = diag(1/norm) U
+        if cholesky_factor is not None:
+            sqrt_icov = cholesky_factor
+        else:
+            sqrt_icov = scipy.linalg.cholesky(icov, lower=False, overwrite_a=True)
+        if decorr is not None:
+            #- C = U^-1 U^-T, so its diagonal blocks are products of
+            #- row blocks of the triangular inverse of U
+            trtri = scipy.linalg.get_lapack_funcs('trtri', (sqrt_icov,))
+            Uinv, info = trtri(sqrt_icov, lower=0, overwrite_c=1)
+            if info != 0:
+                raise np.linalg.LinAlgError("Singular Cholesky factor")
+            sqrt_icov = _sqrt_icov_blocks(Uinv, decorr)
+    else:
+        sqrt_icov = _sqrt_icov_eigh(icov, decorr)
 
-    if issparse(icov):
-        icov = icov.toarray()
+    norm_vector = np.sum(sqrt_icov, axis=1)
 
-    w, v = scipy.linalg.eigh(icov)
+    #- R = diag(1/norm_vector) sqrt_icov as a single broadcast multiply;
+    #- sqrt_icov is a fresh array, so scale it in place rather than
+    #- allocating another n x n matrix
+    R = np.multiply(sqrt_icov, (1.0/norm_vector)[:, None], out=sqrt_icov)
 
-    sqrt_icov = np.zeros_like(icov)
+    ivar = norm_vector**2  #- Bolton & Schlegel 2010 Eqn 13
+    return R, ivar
+
+def _sqrt_icov_eigh(icov, decorr=None):
+    """
+    Square root of the inverse covariance for resolution_from_icov,
+    computed from its eigendecomposition; see resolution_from_icov for args.
+    icov is overwritten.
+    """
+    #- divide and conquer (evd) is faster than the default evr driver
+    #- when all eigenvectors are needed
+    w, v = scipy.linalg.eigh(icov, overwrite_a=True, driver='evd')
 
     if decorr is not None:
-        if np.sum(decorr) != icov.shape[0]:
-            raise RuntimeError("The list of spectral block sizes must sum to the matrix size")
-        inverse = eigen_compose(w, v, invert=True)
-        # take each spectrum block and process
-        offset = 0
-        for b in decorr:
-            bw, bv = scipy.linalg.eigh(inverse[offset:offset+b,offset:offset+b])
-            sqrt_icov[offset:offset+b,offset:offset+b] = eigen_compose(bw, bv, invert=True, sqr=True)
-            offset += b
+        #- Cov = vi vi.T
+        vi = v * np.sqrt(_regularize_eigenvalues(w, invert=True))
+        sqrt_icov = _sqrt_icov_blocks(vi, decorr)
     else:
         sqrt_icov = eigen_compose(w, v, sqr=True)
 
-    norm_vector = np.sum(sqrt_icov, axis=1)
+    return sqrt_icov
 
-    # R = np.outer(norm_vector**(-1), np.ones(norm_vector.size)) * sqrt_icov
-    R = np.empty_like(icov)
-    outer(norm_vector**(-1), np.ones(norm_vector.size), out=R)
-    R *= sqrt_icov
+def _sqrt_icov_blocks(vi, decorr):
+    """
+    Block diagonal square root of the inverse covariance Cov = vi vi.T,
+    with blocks of sizes decorr; see resolution_from_icov
+    """
+    sqrt_icov = np.zeros((vi.shape[0], vi.shape[0]), dtype=vi.dtype)
 
-    ivar = norm_vector**2  #- Bolton & Schlegel 2010 Eqn 13
-    return R, ivar
+    #- Only the diagonal blocks of the covariance are needed, so
+    #- compose them from Cov = vi vi.T instead of the full matrix
+    # take each spectrum block and process
+    offset = 0
+    for b in decorr:
+        vib = vi[offset:offset+b]
+        #- the block is a finite temporary, so skip the copy and NaN scan
+        bw, bv = scipy.linalg.eigh(vib.dot(vib.T), overwrite_a=True, check_finite=False)
+        sqrt_icov[offset:offset+b,offset:offset+b] = eigen_compose(bw, bv, invert=True, sqr=True)
+        offset += b
+
+    return sqrt_icov
 
 def split_bundle(bundlesize, n):
     '''
@@ -589,8 +803,9 @@ def split_bundle(bundlesize, n):
         raise ValueError('n={} should be less or equal to bundlesize={}'.format(
                          n, bundlesize))
 
-    #- initial partition into subbundles
-    n_per_subbundle = [len(x) for x in np.array_split(np.arange(bundlesize), n)]
+    #- initial partition into subbundles, with the first bundlesize % n
+    #- subbundles one larger, as in np.array_split
+    n_per_subbundle = [bundlesize//n + (1 if i < bundlesize % n else 0) for i in range(n)]
 
     #- rearrange to put smaller subbundles in middle instead of at edge,
     #- which can happen when bundlesize % n != 0
@@ -635,30 +850,8 @@ def psfbias(p1, p2, wave, phot, ispec=0, readnoise=3.0):
     Returns:
         bias array same length as wave
     """
-    #- flux -> pixels projection matrices
-    xyrange = p1.xyrange( (ispec,ispec+1), (wave[0], wave[-1]) )
-    A = p1.projection_matrix((ispec,ispec+1), wave, xyrange)
-    B = p2.projection_matrix((ispec,ispec+1), wave, xyrange)
-
-    #- Pixel weights from photon shot noise and CCD read noise
-    img = A.dot(phot)            #- True noiseless image
-    imgvar = readnoise**2 + img  #- pixel variance
-    npix = img.size
-    W = spdiags(1.0/imgvar, 0, npix, npix)
-
-    #- covariance matrix for each PSF
-    iACov = A.T.dot(W.dot(A))
-    iBCov = B.T.dot(W.dot(B))
-    BCov = np.linalg.inv(iBCov.toarray())
-
-    #- Resolution matricies
-    RA, _ = resolution_from_icov(iACov)
-    RB, _ = resolution_from_icov(iBCov)
-
-    #- Bias
-    bias = (RB.dot(BCov.dot(B.T.dot(W.dot(A)).toarray())) - RA).dot(phot) / RA.dot(phot)
-
-    return bias
+    bias, RA = _psfbias(p1, p2, wave, phot, ispec=ispec, readnoise=readnoise)
+    return bias / RA.dot(phot)
 
 def psfabsbias(p1, p2, wave, phot, ispec=0, readnoise=3.0):
     """
@@ -680,6 +873,12 @@ def psfabsbias(p1, p2, wave, phot, ispec=0, readnoise=3.0):
 
     See psfbias() for relative bias
     """
+    return _psfbias(p1, p2, wave, phot, ispec=ispec, readnoise=readnoise)
+
+def _psfbias(p1, p2, wave, phot, ispec=0, readnoise=3.0):
+    """
+    Absolute bias and resolution matrix for psfbias() and psfabsbias()
+    """
     #- flux -> pixels projection matrices
     xyrange = p1.xyrange( (ispec,ispec+1), (wave[0], wave[-1]) )
     A = p1.projection_matrix((ispec,ispec+1), wave, xyrange)
@@ -691,16 +890,17 @@ def psfabsbias(p1, p2, wave, phot, ispec=0, readnoise=3.0):
     npix = img.size
     W = spdiags(1.0/imgvar, 0, npix, npix)
 
-    #- covariance matrix for each PSF
-    iACov = A.T.dot(W.dot(A))
-    iBCov = B.T.dot(W.dot(B))
-    BCov = np.linalg.inv(iBCov.toarray())
+    #- inverse covariance matrix for each PSF, converted to dense once
+    iACov = A.T.dot(W.dot(A)).toarray()
+    iBCov = B.T.dot(W.dot(B)).toarray()
 
     #- Resolution matricies
     RA, _ = resolution_from_icov(iACov)
     RB, _ = resolution_from_icov(iBCov)
 
-    #- Bias
-    bias = (RB.dot(BCov.dot(B.T.dot(W.dot(A)).toarray())) - RA).dot(phot)
+    #- Bias: solve iBCov X = B^T W A rather than explicitly inverting iBCov
+    BtWA = B.T.dot(W.dot(A)).toarray()
+    X = scipy.linalg.solve(iBCov, BtWA, assume_a='pos', overwrite_a=True, overwrite_b=True)
+    bias = (RB.dot(X) - RA).dot(phot)
 
     return bias, RA
@@ -662,10 +662,14 @@ class PSF(object):
             #make sure legval_dict is empty if we're not using it
             self.legval_dict = None
 
-        #- Generate A
-        #- Start with a transposed version to fill it more efficiently
-        A = np.zeros( (nspec*nflux, ny*nx) )
-        tmp = np.zeros((ny, nx))
+        #- Generate A directly in sparse form from the non-zero pixels of
+        #- each spot instead of filling a dense [nspec*nflux, ny*nx] array
+        #- that is mostly zeros.  Each spot is one column of A and spots are
+        #- visited in column order with increasing pixel index, so this
+        #- is already CSC layout: no (pixel, flux) triplets to sort.
+        data = list()
+        ipix = list()
+        nnz = np.zeros(nspec*nflux, dtype=np.int64)
         for ispec_cache, ispec in enumerate(range(specmin, specmax)):
             for iflux, w in enumerate(wavelengths):
                 #- Get subimage and index slices
@@ -674,18 +678,33 @@ class PSF(object):
                 xslice, yslice, pix = self.xypix(ispec, w, xmin=xmin, xmax=xmax,
                     ymin=ymin, ymax=ymax, ispec_cache=ispec_cache, iwave_cache=iflux)
 
-                #- If there is overlap with pix_range, put into sub-region of A
+                #- If there is overlap with pix_range, add non-zero pixels to A
                 if pix.shape[0]>0 and pix.shape[1]>0:
-                    tmp[yslice, xslice] = pix
-                    ij = (ispec-specmin)*nflux + iflux
-                    A[ij, :] = tmp.ravel()
-                    tmp[yslice, xslice] = 0.0
+                    ii = np.arange(yslice.start, yslice.stop)[:, None]*nx + \
+                         np.arange(xslice.start, xslice.stop)[None, :]
+                    nonzero = (pix != 0.0)
+                    data.append(pix[nonzero])
+                    ipix.append(ii[nonzero])
+                    nnz[(ispec-specmin)*nflux + iflux] = len(data[-1])
 
         #when we are finished with legval_dict clear it out
         #this is important so we don't enter the cached branch of _xypix at the wrong time
         self.legval_dict = None
 
-        return scipy.sparse.csr_matrix(A.T)
+        if len(data) > 0:
+            data = np.concatenate(data)
+            ipix = np.concatenate(ipix)
+        else:
+            data = np.zeros(0)
+            ipix = np.zeros(0, dtype=np.int64)
+
+        indptr = np.concatenate(([0,], np.cumsum(nnz)))
+        A = scipy.sparse.csc_matrix((data, ipix, indptr),
+                                    shape=(ny*nx, nspec*nflux))
+
+        #- CSC -> CSR is a linear time transpose that keeps the indices
+        #- sorted, giving the same CSR matrix as the original dense -> CSR
+        return A.tocsr()
 
     def cache_params(self, spec_range, wavelengths):
         """
@@ -11,9 +11,11 @@ import os
 import numpy as np
 import scipy.linalg
 import unittest
+from unittest import mock
 from pkg_resources import resource_filename
 from specter.psf import load_psf
-from specter.extract.ex2d import ex2d, ex2d_patch, eigen_compose, split_bundle, psfbias, psfabsbias
+from specter.extract.ex2d import ex2d, ex2d_patch, eigen_compose, split_bundle, psfbias, psfabsbias, resolution_from_icov
+from specter.extract.ex2d import _solve_icov
 from specter.extract.ex1d import ex1d
 
 class TestExtract(unittest.TestCase):
@@ -83,6 +85,72 @@ class TestExtract(unittest.TestCase):
         comp = eigen_compose(comp_w, v_inv, invert=True)
         np.testing.assert_almost_equal(comp, self.sym, decimal=3)
 
+    def test_resolution_from_icov(self):
+        d = ex2d_patch(self.image, self.ivar, self.psf, 0, self.nspec, self.ww, full_output=True)
+        icov = d['iCov']
+        cov = np.linalg.inv(icov)
+        for method in ('eigh', 'cholesky'):
+            R, ivar = resolution_from_icov(icov, method=method)
+            #- rows of R are normalized and R C R.T is diagonal with 1/ivar
+            np.testing.assert_allclose(R.sum(axis=1), 1.0)
+            rcov = R.dot(cov.dot(R.T))
+            np.testing.assert_allclose(np.diag(rcov)*ivar, 1.0, rtol=1e-6)
+            offdiag = rcov - np.diag(np.diag(rcov))
+            self.assertLess(np.max(np.abs(offdiag)), 1e-6*np.max(np.diag(rcov)))
+
+        #- with decorr both methods give the same block diagonal R
+        decorr = [len(self.ww),]*self.nspec
+        R1, ivar1 = resolution_from_icov(icov, decorr=decorr, method='eigh')
+        R2, ivar2 = resolution_from_icov(icov, decorr=decorr, method='cholesky')
+        np.testing.assert_allclose(R2, R1, atol=1e-8)
+        np.testing.assert_allclose(ivar2, ivar1, rtol=1e-6)
+
+        #- ivar = norm**2 is also the exact diagonal of R C R.T with decorr,
+        #- so R C R.T never needs to be computed
+        rcov = R1.dot(cov.dot(R1.T))
+        np.testing.assert_allclose(np.diag(rcov)*ivar1, 1.0, rtol=1e-6)
+
+        with self.assertRaises(ValueError):
+            resolution_from_icov(icov, method='blat')
+
+    def test_solve_icov_cg(self):
+        #- positive semidefinite with a zero diagonal entry: Cholesky fails
+        #- and the Jacobi preconditioned CG fallback solves it
+        icov = np.array([[4.0, 1.0, 0.0], [1.0, 3.0, 0.0], [0.0, 0.0, 0.0]])
+        y = np.array([1.0, 2.0, 0.0])
+        with self.assertRaises(np.linalg.LinAlgError):
+            scipy.linalg.cholesky(icov)
+        ex2dmod = sys.modules[_solve_icov.__module__]
+        with mock.patch.object(ex2dmod, 'minres', wraps=ex2dmod.minres) as mr:
+            x = _solve_icov(icov, y)
+            self.assertFalse(mr.called)
+        np.testing.assert_allclose(icov.dot(x), y, atol=1e-8)
+
+    def test_solve_icov_indefinite(self):
+        #- symmetric indefinite: Cholesky fails, CG doesn't converge within
+        #- maxiter and MINRES (warm started from CG) solves it
+        rng = np.random.RandomState(0)
+        n = 6
+        q, _ = np.linalg.qr(rng.normal(size=(n, n)))
+        w = np.concatenate([np.linspace(1, 10, n//2), -np.linspace(1, 10, n//2)])
+        icov = (q*w).dot(q.T)
+        icov = (icov + icov.T)/2
+        y = rng.normal(size=n)
+        ex2dmod = sys.modules[_solve_icov.__module__]
+        with mock.patch.object(ex2dmod, 'minres', wraps=ex2dmod.minres) as mr, \
+             mock.patch.object(ex2dmod, 'spsolve', wraps=ex2dmod.spsolve) as sp:
+            x = _solve_icov(icov, y)
+            self.assertTrue(mr.called)
+            self.assertFalse(sp.called)
+        np.testing.assert_allclose(icov.dot(x), y, atol=1e-8)
+
+        #- if MINRES fails too, the final sparse direct solve is used
+        with mock.patch.object(ex2dmod, 'minres', return_value=(np.zeros(n), 1)), \
+             mock.patch.object(ex2dmod, 'spsolve', wraps=ex2dmod.spsolve) as sp:
+            x = _solve_icov(icov, y)
+            self.assertTrue(sp.called)
+        np.testing.assert_allclose(icov.dot(x), y, atol=1e-8)
+
     def test_ex1d(self):
         specrange = (0, self.nspec)
         mask = np.zeros(self.image.shape, dtype=int)
@@ -195,6 +263,45 @@ class TestExtract(unittest.TestCase):
         self.assertTrue(np.all(ivar1 == ivar2))
         self.assertTrue(np.all(R1 == R2))
 
+    def test_ex2d_float32(self):
+        flux64, ivar64, R64 = ex2d(self.image, self.ivar, self.psf, 0, self.nspec,
+            self.ww, wavesize=len(self.ww)//5)
+        flux32, ivar32, R32 = ex2d(self.image, self.ivar, self.psf, 0, self.nspec,
+            self.ww, wavesize=len(self.ww)//5, dtype=np.float32)
+
+        #- outputs are float64 either way
+        self.assertEqual(flux32.dtype, np.float64)
+        self.assertEqual(ivar32.dtype, np.float64)
+        self.assertEqual(R32.dtype, np.float64)
+
+        #- float32 differences are small compared to the flux errors
+        pull = (flux32 - flux64) * np.sqrt(ivar64)
+        self.assertLess(np.max(np.abs(pull)), 0.01)
+        self.assertTrue(np.allclose(ivar32, ivar64, rtol=1e-4))
+        self.assertTrue(np.allclose(R32, R64, atol=1e-4))
+
+    def test_ex2d_cholesky(self):
+        #- with per-fiber decorrelation (the default) both methods
+        #- give the same resolution matrix and thus the same outputs
+        flux1, ivar1, R1 = ex2d(self.image, self.ivar, self.psf, 0, self.nspec,
+            self.ww, wavesize=len(self.ww)//5)
+        flux2, ivar2, R2 = ex2d(self.image, self.ivar, self.psf, 0, self.nspec,
+            self.ww, wavesize=len(self.ww)//5, method='cholesky')
+        self.assertTrue(np.allclose(flux2, flux1, rtol=1e-6, atol=1e-6))
+        self.assertTrue(np.allclose(ivar2, ivar1, rtol=1e-6))
+        self.assertTrue(np.allclose(R2, R1, atol=1e-8))
+
+        #- dtype only sets the precision of the normal equations here;
+        #- the Cholesky factorization itself is always float64
+        flux3, ivar3, R3 = ex2d(self.image, self.ivar, self.psf, 0, self.nspec,
+            self.ww, wavesize=len(self.ww)//5, method='cholesky', dtype=np.float32)
+        self.assertEqual(flux3.dtype, np.float64)
+        self.assertEqual(R3.dtype, np.float64)
+        pull = (flux3 - flux2) * np.sqrt(ivar2)
+        self.assertLess(np.max(np.abs(pull)), 0.01)
+        self.assertTrue(np.allclose(ivar3, ivar2, rtol=1e-4))
+        self.assertTrue(np.allclose(R3, R2, atol=1e-4))
+
     def test_ex2d_xyrange(self):
         xyrange = xmin,xmax,ymin,ymax = self.psf.xyrange([0,self.nspec], self.ww)
         subimage = self.image[ymin:ymax, xmin:xmax]
@@ -10,7 +10,10 @@ import os
 import numpy as np
 import unittest
 from pkg_resources import resource_filename
-from ..throughput import load_throughput
+from ..throughput import load_throughput, Throughput
+
+def _trapz(y, x):
+    return np.sum(0.5*(y[1:]+y[:-1])*np.diff(x))
 
 class TestThroughput(unittest.TestCase):
 
@@ -165,6 +168,39 @@ class TestThroughput(unittest.TestCase):
         self.assertTrue( np.all( (p2>p3) | (p2==0.0) ) )
         self.assertTrue( np.any(p3>0.0) )
 
+    def test_phot_shape_mismatch(self):
+        for n in (len(self.w)//2, len(self.w)+500):
+            with self.assertRaises(ValueError):
+                self.thru.photons(self.w, np.ones(n), objtype='STAR')
+
+    def test_masked_phot(self):
+        flux = np.ma.masked_array(self.flux, mask=np.zeros(len(self.w), dtype=bool))
+        flux.mask[10:20] = True
+        p = self.thru.photons(self.w, flux, objtype='STAR')
+        self.assertTrue(np.ma.isMaskedArray(p))
+        self.assertTrue(np.all(p.mask == flux.mask))
+
+    def test_multispec_phot(self):
+        flux = np.array([self.flux, 2*self.flux, 3*self.flux])
+        for objtype in ['CALIB', 'SKY', 'STAR']:
+            p = self.thru.photons(self.w, flux, objtype=objtype, airmass=1.2)
+            self.assertEqual(p.shape, flux.shape)
+            for i in range(flux.shape[0]):
+                p1 = self.thru.photons(self.w, flux[i], objtype=objtype, airmass=1.2)
+                self.assertTrue(np.allclose(p[i], p1, rtol=1e-14, atol=0))
+
+    def test_photons_specialized(self):
+        for units in ["erg/s/cm^2/A", "1e-17 erg/s/cm^2/A/arcsec^2", "photon/A"]:
+            for objtype in ['SKY', 'STAR']:
+                photons = self.thru.photons_specialized(units=units,
+                    objtype=objtype, exptime=100.0, airmass=1.2)
+                for w in (self.w, self.w, self.w[0::2]):
+                    flux = self.flux[0:len(w)]
+                    p0 = self.thru.photons(w, flux, units=units,
+                        objtype=objtype, exptime=100.0, airmass=1.2)
+                    p1 = photons(w, flux)
+                    self.assertTrue(np.allclose(p1, p0, rtol=1e-14, atol=0))
+
     def test_apply_throughput(self):
         f1 = self.thru.apply_throughput(self.w, self.flux, objtype='CALIB')
         f2 = self.thru.apply_throughput(self.w, self.flux, objtype='SKY')
@@ -190,6 +226,88 @@ class TestThroughput(unittest.TestCase):
         self.assertTrue( np.all(fx[1] <= fx[0]) )
         self.assertTrue( np.all(fx[2] <= fx[1]) )
 
+    def test_binned(self):
+        t0 = self.thru(self.w, objtype='STAR', airmass=1.2)
+        t1 = self.thru(self.w, objtype='STAR', airmass=1.2, binned=True)
+        self.assertEqual(t1.shape, t0.shape)
+        self.assertTrue(np.all( (0.0<=t1) & (t1<= 1.0)))
+
+        #- Bins cover the full throughput range: integral is conserved
+        wave = self.thru._wave
+        T = self.thru(wave, objtype='STAR', airmass=1.2)
+        self.assertAlmostEqual(np.sum(t1)/_trapz(T, wave), 1.0, 10)
+
+        #- Coarse grid within the range: also conserved
+        wcoarse = np.linspace(wave[0]+50, wave[-1]-50, 20)
+        dw = np.gradient(wcoarse)
+        t2 = self.thru(wcoarse, objtype='STAR', airmass=1.2, binned=True)
+        ii = (wcoarse[0]-dw[0]/2 <= wave) & (wave <= wcoarse[-1]+dw[-1]/2)
+        self.assertAlmostEqual(np.sum(t2*dw)/_trapz(T[ii], wave[ii]), 1.0, 3)
+
+        f = self.thru.apply_throughput(self.w, self.flux, objtype='STAR',
+            airmass=1.2, binned=True)
+        self.assertTrue(np.allclose(f, self.flux*t1))
+
+    def test_float32(self):
+        thru32 = load_throughput(resource_filename('specter.test', 't/throughput.fits'),
+            dtype=np.float32)
+        for objtype in ['CALIB', 'SKY', 'STAR']:
+            t64 = self.thru(self.w, objtype=objtype, airmass=1.2)
+            t32 = thru32(self.w, objtype=objtype, airmass=1.2)
+            self.assertEqual(t32.dtype, np.float32)
+            self.assertTrue(np.allclose(t32, t64, rtol=1e-5, atol=1e-7))
+
+            p64 = self.thru.photons(self.w, self.flux, objtype=objtype)
+            p32 = thru32.photons(self.w, self.flux, objtype=objtype)
+            self.assertTrue(np.allclose(p32, p64, rtol=1e-5, atol=1e-7*np.max(p64)))
+
+    def test_fiberinput_dict(self):
+        wave = np.linspace(5000, 6000, 11)
+        star = np.full(len(wave), 0.8)
+        fiberinput = dict(STAR=star)
+        thru = Throughput(wave, np.ones(len(wave)), np.ones(len(wave)),
+            exptime=1, area=1, fiberdia=1, fiberinput=fiberinput,
+            dtype=np.float32)
+
+        #- caller's dict and arrays are not modified
+        self.assertEqual(list(fiberinput.keys()), ['STAR'])
+        self.assertIs(fiberinput['STAR'], star)
+        self.assertEqual(star.dtype, np.float64)
+        self.assertFalse(np.shares_memory(thru.fiberinput_throughput(objtype='STAR'), star))
+        self.assertTrue(np.allclose(thru.fiberinput_throughput(objtype='QSO'), 0.8))
+
+    def test_throughput_cache(self):
+        for objtype in ['CALIB', 'SKY', 'STAR']:
+            T1 = self.thru._throughput(objtype=objtype, airmass=1.3)
+            T0 = T1.copy()
+            with self.assertRaises(ValueError):
+                T1 *= 2
+            T2 = self.thru._throughput(objtype=objtype, airmass=1.3)
+            self.assertTrue(np.array_equal(T2, T0))
+
+        #- CALIB result doesn't make the hardware throughput read-only
+        self.assertTrue(self.thru._thru.flags.writeable)
+
+    def test_native_grid(self):
+        w = self.thru._wave.copy()
+        for objtype in ['CALIB', 'SKY', 'STAR']:
+            t = self.thru(w, objtype=objtype, airmass=1.2)
+            T = self.thru._throughput(objtype=objtype, airmass=1.2)
+            self.assertTrue(np.array_equal(t, np.interp(w, w, T, left=0, right=0)))
+            #- result is writable without modifying internal arrays
+            t *= 2
+            self.assertFalse(np.shares_memory(t, T))
+            self.assertFalse(np.shares_memory(t, self.thru._thru))
+
+    def test_apply_throughput_multi_int(self):
+        flux = np.ones((2, len(self.w)), dtype=int)
+        objtype = ['STAR', 'SKY']
+        fx = self.thru.apply_throughput(self.w, flux, objtype=objtype)
+        self.assertTrue(np.issubdtype(fx.dtype, np.floating))
+        for i in range(len(objtype)):
+            t = self.thru(self.w, objtype=objtype[i])
+            self.assertTrue(np.allclose(fx[i], t))
+
     def test_wavemin_wavemax(self):
         wavemin = self.thru.wavemin
         wavemax = self.thru.wavemax
@@ -21,7 +21,10 @@ import sys
 import os
 import warnings
 import numbers
+import math
+import re
 import numpy as np
+import numba
 from astropy.io import fits
 from specter import util
 
@@ -36,9 +39,118 @@ class ObjType:
     SKY    = 'SKY'
     CALIB  = 'CALIB'
 
-def load_throughput(filename):
+#- 10**(-0.4*x) == exp(-_LN10_OVER_2P5*x); exp is cheaper than pow
+_LN10_OVER_2P5 = 0.4 * math.log(10.0)
+
+@numba.jit(nopython=True, cache=False)
+def _erg_to_photons(flux, thru, wavelength, dw, scale, per_angstrom):
+    """
+    Fused flux * thru * wavelength * scale [* dw] in a single pass;
+    scale includes 1/hc, exptime, area and any fiber area factor
+    """
+    phot = np.empty(flux.shape[0])
+    for i in range(flux.shape[0]):
+        phot[i] = flux[i] * thru[i] * wavelength[i] * scale
+        if per_angstrom:
+            phot[i] *= dw[i]
+    return phot
+
+#- Standardized flux units -> (applies throughput, per Angstrom, per arcsec^2)
+_UNIT_CODES = {
+    "photon":                (False, False, False),
+    "photon/A":              (False, True,  False),
+    "erg/s/cm^2":            (True,  False, False),
+    "erg/s/cm^2/A":          (True,  True,  False),
+    "erg/s/cm^2/arcsec^2":   (True,  False, True),
+    "erg/s/cm^2/A/arcsec^2": (True,  True,  True),
+}
+
+#- Sloppy unit spellings and their standard form, matched in a single pass;
+#- longer alternatives first so that e.g. "Angstroms" isn't matched as "Ang"
+_UNIT_SPELLINGS = {
+    "ergs": "erg",
+    "photons": "photon",
+    "Angstroms": "A",
+    "Angstrom": "A",
+    "Ang": "A",
+    "**": "^",
+    "cm2": "cm^2",
+    "arcsec2": "arcsec^2",
+}
+_UNIT_RE = re.compile('|'.join(re.escape(key) for key in
+    sorted(_UNIT_SPELLINGS, key=len, reverse=True)))
+
+def _standardize_units(units):
+    """
+    Returns scale, units for units string like "1e-17 ergs/s/cm2/Angstrom",
+    allowing some sloppiness in the spelling of the units
+    """
+    units = units.strip()  #- FITS pads short strings with spaces (!)
+    units = _UNIT_RE.sub(lambda m: _UNIT_SPELLINGS[m.group()], units)
+
+    #- Check for units prefactor like "1e-17 erg/s/cm^2/A"
+    scale = 1.0
+    tmp = units.split()
+    if len(tmp) == 2:
+        try:
+            scale = float(tmp[0])
+            units = tmp[1]
+        except ValueError:
+            raise ValueError("Non-numeric units scale factor {}".format(tmp[0]))
+
+    return scale, units
+
+def _bin_width(wavelength):
+    """
+    Wavelength bin widths; equivalent to np.gradient(wavelength) for 1D
+    input but without its generic edge handling and temporaries
+    """
+    wavelength = np.asarray(wavelength)
+    if wavelength.ndim != 1 or wavelength.size < 2:
+        raise ValueError("wavelength must be a 1D array with at least 2 elements")
+
+    dw = np.empty(wavelength.shape, dtype=np.result_type(wavelength, 1.0))
+    np.subtract(wavelength[2:], wavelength[:-2], out=dw[1:-1])
+    dw[1:-1] *= 0.5
+    dw[0] = wavelength[1] - wavelength[0]
+    dw[-1] = wavelength[-1] - wavelength[-2]
+    return dw
+
+def _column(data, name):
+    """
+    Returns column `name` of FITS table `data` as a contiguous native-endian
+    float64 array instead of a strided big-endian view into the records
+    """
+    return np.ascontiguousarray(data[name], dtype=np.float64)
+
+def _bin_edges(wavelength):
+    """
+    Wavelength bin edges halfway between wavelength centers, with the
+    outermost edges extrapolated by half a bin
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    edges = np.empty(len(wavelength)+1)
+    edges[1:-1] = 0.5*(wavelength[1:] + wavelength[:-1])
+    edges[0] = 1.5*wavelength[0] - 0.5*wavelength[1]
+    edges[-1] = 1.5*wavelength[-1] - 0.5*wavelength[-2]
+    return edges
+
+def _bin_average(x, y, edges):
+    """
+    Average of piecewise linear y(x) over each bin [edges[i], edges[i+1]],
+    treating y as 0 outside the range of x
+    """
+    #- cumulative trapezoidal integral of y evaluated at x
+    cum = np.zeros(len(x))
+    np.cumsum(0.5*(y[1:] + y[:-1])*np.diff(x), out=cum[1:])
+    cedges = np.interp(edges, x, cum)
+    return np.diff(cedges) / np.diff(edges)
+
+def load_throughput(filename, dtype=np.float64):
     """
     Create Throughput object from FITS file with EXTNAME=THROUGHPUT HDU
+
+    dtype is passed to Throughput for the throughput arrays
     """
     #- memmap=False so that fits will really close the file upon fx.close()
     fx = fits.open(filename, memmap=False)
@@ -51,15 +163,15 @@ def load_throughput(filename):
         assert(len(tmp) == len(thru))
         fiberinput = dict()
         for key in tmp.dtype.names:
-            fiberinput[key.upper()] = tmp[key]
+            fiberinput[key.upper()] = _column(tmp, key)
     else:
         print("no FIBERINPUT extention found")
-        fiberinput = thru['fiberinput']
+        fiberinput = _column(thru, 'fiberinput')
 
     if 'wavelength' in thru.dtype.names:
-        w = thru['wavelength']
+        w = _column(thru, 'wavelength')
     elif 'loglam' in thru.dtype.names:
-        w = 10**thru['loglam']
+        w = 10**_column(thru, 'loglam')
     else:
         fx.close()
         raise ValueError('throughput must include wavelength or loglam')
@@ -78,17 +190,20 @@ def load_throughput(filename):
 
     return Throughput(
         wave = w,
-        throughput = thru['throughput'],
-        extinction = thru['extinction'],
+        throughput = _column(thru, 'throughput'),
+        extinction = _column(thru, 'extinction'),
         fiberinput = fiberinput,
         exptime    = hdr['EXPTIME'],
         area       = area,
         fiberdia   = hdr['FIBERDIA'],
+        dtype      = dtype,
+        copy       = False,  #- columns above are already our own arrays
         )
 
 class Throughput:
     def __init__(self, wave, throughput, extinction,
-        exptime, area, fiberdia, fiberinput=None):
+        exptime, area, fiberdia, fiberinput=None, dtype=np.float64,
+        copy=True):
         """
         Create Throughput object
 
@@ -108,15 +223,26 @@ class Throughput:
         fiberinput : float, array, or dictionary of arrays keyed by objtype.
             Geometric throughput due to finite sized fiber input.
             Default to no loss = 1.0.
+        dtype : dtype for throughput, extinction, and fiberinput arrays,
+            e.g. np.float32 to halve their memory and bandwidth.
+            Wavelengths are always float64.
+        copy : if False, use the input arrays without copying when they
+            are already contiguous with the requested dtype.
 
         Notes
         -----
         fiberinput is a placeholder, since it really depends upon the
         spatial extent of the object and the seeing.
         """
-        self._wave = np.copy(wave)
-        self._thru = np.copy(throughput)
-        self._extinction  = np.copy(extinction)
+        #- contiguous native arrays for the elementwise math below
+        if copy:
+            _array = np.array
+        else:
+            _array = np.ascontiguousarray
+
+        self._wave = _array(wave, dtype=np.float64)
+        self._thru = _array(throughput, dtype=dtype)
+        self._extinction  = _array(extinction, dtype=dtype)
 
         self.exptime = float(exptime)
         self.area = float(area)
@@ -125,21 +251,25 @@ class Throughput:
         #- Flux -> photons conversion constant
         #-         h [erg s]      * c [m/s]      * [1e10 A/m] = [erg A]
         self._hc = 6.62606957e-27 * 2.99792458e8 * 1e10
+        self._inv_hc = 1.0 / self._hc
 
         #- Create fiber input dict keyed by object type, including 'default'
         if fiberinput is not None:
             if isinstance(fiberinput, numbers.Real):
-                self._fiberinput = dict(default=np.ones(len(wave)) * fiberinput)
+                self._fiberinput = dict(default=np.full(len(wave), fiberinput, dtype=dtype))
             elif isinstance(fiberinput, np.ndarray):
-                self._fiberinput = dict(default=np.copy(fiberinput))
+                self._fiberinput = dict(default=_array(fiberinput, dtype=dtype))
             elif isinstance(fiberinput, dict):
-                self._fiberinput = fiberinput
-                if 'default' not in fiberinput:
-                    self._fiberinput['default'] = np.ones(len(wave))
+                #- new dict so that the caller's dict and arrays are untouched
+                self._fiberinput = dict()
+                for key, value in fiberinput.items():
+                    self._fiberinput[key] = _array(value, dtype=dtype)
+                if 'default' not in self._fiberinput:
+                    self._fiberinput['default'] = np.ones(len(wave), dtype=dtype)
             else:
                 raise ValueError('Unrecognized type for fiberinput: {}'.format(type(fiberinput)))
         else:
-            self._fiberinput = dict(default=np.ones(len(wave)))
+            self._fiberinput = dict(default=np.ones(len(wave), dtype=dtype))
 
         #- special cases: QSO and STD are STAR for fiber input losses
         if 'STAR' in self._fiberinput and 'STD' not in self._fiberinput:
@@ -147,18 +277,92 @@ class Throughput:
         if 'STAR' in self._fiberinput and 'QSO' not in self._fiberinput:
             self._fiberinput['QSO'] = self._fiberinput['STAR']
 
+        #- Precompute airmass-independent products used by _throughput
+        self._neg_ext_coeff = -_LN10_OVER_2P5 * self._extinction
+        self._thru_x_fiberinput = dict()
+        for key, value in self._fiberinput.items():
+            self._thru_x_fiberinput[key] = self._thru * value
+
+        #- Cache of native-grid throughput arrays keyed by (objtype, airmass)
+        self._T_cache = util.CacheDict(100)
+
+        #- Interpolation weights for the last requested wavelength grid
+        self._interp_cache = None
+        self._wave_increasing = len(self._wave) > 1 and \
+            bool(np.all(np.diff(self._wave) > 0))
+
+    def _interp(self, wavelength, y, left=None, right=None):
+        """
+        np.interp(wavelength, self._wave, y) that returns a copy of y when
+        wavelength is the native grid, which is common when the same grid
+        is reused for many spectra
+        """
+        w = self._wave
+        if wavelength is w or (isinstance(wavelength, np.ndarray)
+                and wavelength.shape == w.shape
+                and wavelength[0] == w[0] and wavelength[-1] == w[-1]
+                and np.array_equal(wavelength, w)):
+            return np.array(y)
+
+        if not (self._wave_increasing and isinstance(wavelength, np.ndarray)
+                and wavelength.ndim == 1):
+            return np.interp(wavelength, w, y, left=left, right=right)
+
+        #- Same as np.interp, but reusing the bin search for the same grid
+        idx, frac, below, above = self._interp_weights(wavelength)
+        ylo = y[idx]
+        result = y[idx+1] - ylo
+        result *= frac
+        result += ylo
+        result[below] = y[0] if left is None else left
+        result[above] = y[-1] if right is None else right
+        return result
+
+    def _interp_weights(self, wavelength):
+        """
+        Returns idx, frac, below, above for linear interpolation from
+        self._wave onto 1D array wavelength, where idx is the lower bin
+        index, frac the fractional position within that bin, and below/above
+        index the wavelengths outside the range of self._wave.
+
+        Cached for the most recent wavelength grid.
+        """
+        cache = self._interp_cache
+        if cache is not None and cache[0].shape == wavelength.shape \
+                and np.array_equal(cache[0], wavelength):
+            return cache[1:]
+
+        w = self._wave
+        idx = np.searchsorted(w, wavelength, side='right') - 1
+        np.clip(idx, 0, len(w)-2, out=idx)
+        frac = (wavelength - w[idx]) / (w[idx+1] - w[idx])
+        below = np.flatnonzero(wavelength < w[0])
+        above = np.flatnonzero(wavelength > w[-1])
+
+        self._interp_cache = (wavelength.copy(), idx, frac, below, above)
+        return idx, frac, below, above
+
+    @property
+    def fiberdia(self):
+        """Fiber diameter [arcsec]"""
+        return self._fiberdia
+
+    @fiberdia.setter
+    def fiberdia(self, value):
+        self._fiberdia = float(value)
+        self._fiberarea = math.pi * self._fiberdia**2 / 4.0
 
     @property
     def fiberarea(self):
         """Average fiber area [arcsec^2] used for fiber input calculations"""
-        return np.pi * self.fiberdia**2 / 4.0
+        return self._fiberarea
 
     def extinction(self, wavelength):
         """
         Return atmospheric extinction [magnitudes/airmass]
         evaluated at wavelength (float or array)
         """
-        return np.interp(wavelength, self._wave, self._extinction)
+        return self._interp(wavelength, self._extinction)
 
     def atmospheric_throughput(self, wavelength, airmass=1.0):
         """
@@ -166,7 +370,7 @@ class Throughput:
         evaluated at wavelength (float or array)
         """
         ext = self.extinction(wavelength)
-        return 10**(-0.4 * airmass * ext)
+        return np.exp(-airmass * _LN10_OVER_2P5 * ext)
 
     def fiberinput_throughput(self, wavelength=None, objtype=ObjType.STAR):
         """
@@ -185,7 +389,7 @@ class Throughput:
         if wavelength is None:
             return t
         else:
-            return np.interp(wavelength, self._wave, t)
+            return self._interp(wavelength, t)
 
     def hardware_throughput(self, wavelength):
         """
@@ -193,7 +397,7 @@ class Throughput:
         not including atmosphere or geometric fiber input losses)
         evaluated at wavelength (float or array)
         """
-        return np.interp(wavelength, self._wave, self._thru, left=0.0, right=0.0)
+        return self._interp(wavelength, self._thru, left=0.0, right=0.0)
 
     def _throughput(self, objtype=ObjType.STAR, airmass=1.0):
         """
@@ -204,21 +408,38 @@ class Throughput:
             CALIB : atmospheric extinction and fiber input losses not applied
             SKY   : fiber input losses are not applied
             other : all throughput losses are applied
+
+        The returned array is cached and read-only; copy it before
+        modifying it.  Because of the caching, the warning for an unknown
+        objtype is only issued on the first call for each objtype, airmass.
         """
         objtype = objtype.strip().upper()
 
-        Tatm = 10**(-0.4*airmass*self._extinction)
+        #- Loops over many spectra typically reuse the same objtype/airmass
+        key = (objtype, float(airmass))
+        if key in self._T_cache:
+            return self._T_cache[key]
+
         if objtype == ObjType.CALIB:
-            T = self._thru
-        elif objtype == ObjType.SKY:
-            T = self._thru * Tatm
+            T = self._thru.view()
         else:
-            Tfiber = self.fiberinput_throughput(wavelength=None, objtype=objtype)
-            T = self._thru * Tatm * Tfiber
+            T = np.exp(airmass * self._neg_ext_coeff)
+            if objtype == ObjType.SKY:
+                T *= self._thru
+            elif objtype in self._thru_x_fiberinput:
+                T *= self._thru_x_fiberinput[objtype]
+            else:
+                #- warns about the unknown objtype, then use the default
+                self.fiberinput_throughput(wavelength=None, objtype=objtype)
+                T *= self._thru_x_fiberinput['default']
 
+        #- read-only so that callers can't corrupt the cache (or self._thru)
+        T.flags.writeable = False
+        self._T_cache[key] = T
         return T
 
-    def __call__(self, wavelength, objtype=ObjType.STAR, airmass=1.0):
+    def __call__(self, wavelength, objtype=ObjType.STAR, airmass=1.0,
+                 binned=False):
         """
         Returns system throughput at requested wavelength(s)
 
@@ -226,10 +447,18 @@ class Throughput:
             CALIB : atmospheric extinction and fiber input losses not applied
             SKY   : fiber input losses are not applied
             other : all throughput losses are applied
+
+        If binned is True, return the throughput averaged over wavelength
+        bins centered on the input wavelength array instead of sampled at
+        those wavelengths; more accurate when the throughput has structure
+        smaller than the wavelength sampling.
         """
 
         T = self._throughput(objtype=objtype, airmass=airmass)
-        return np.interp(wavelength, self._wave, T, left=0.0, right=0.0)
+        if binned:
+            return _bin_average(self._wave, T, _bin_edges(wavelength))
+        else:
+            return self._interp(wavelength, T, left=0.0, right=0.0)
 
     def thru(self, *args, **kwargs):
         """
@@ -238,7 +467,7 @@ class Throughput:
         return self(*args, **kwargs)
 
     def photons(self, wavelength, flux, units="erg/s/cm^2/A", \
-                objtype="STAR", exptime=None, airmass=1.0):
+                objtype="STAR", exptime=None, airmass=1.0, binned=False):
         """
         Returns photons per bin given input flux vs. wavelength,
         flux units, object type, exposure time, and airmass.
@@ -249,7 +478,8 @@ class Throughput:
         Inputs
         ------
         wavelength : input wavelength array in Angstroms
-        flux       : input flux; same length as `wavelength`
+        flux       : input flux; same length as `wavelength`, or 2D
+                     [nspec, len(wavelength)] for spectra on the same grid
         units      : units of `flux`
           * Treated as delta functions at each given wavelength:
             - "photons"
@@ -273,6 +503,8 @@ class Throughput:
                     with all throughput terms applied.
         exptime : float, optional; exposure time, default self.exptime
         airmass : float, optional, default 1.0
+        binned : bool, optional; if True, apply throughput averaged over
+            each wavelength bin instead of sampled at each wavelength
 
         Returns
         -------
@@ -284,93 +516,146 @@ class Throughput:
         """
 
         #- Wavelength bin size
-        dw = np.gradient(wavelength)
-
-        #- Standardize units; allow some sloppiness
-        units = units.strip()  #- FITS pads short strings with spaces (!)
-        units = units.replace("ergs", "erg")
-        units = units.replace("photons", "photon")
-        units = units.replace("Angstroms", "A")
-        units = units.replace("Angstrom", "A")
-        units = units.replace("Ang", "A")
-        units = units.replace("**", "^")
-        units = units.replace("cm2", "cm^2")
-        units = units.replace("arcsec2", "arcsec^2")
-
-        #- Check for units prefactor like "1e-17 erg/s/cm^2/A"
-        scale = 1.0
-        tmp = units.split()
-        if len(tmp) == 2:
-            try:
-                scale = float(tmp[0])
-                flux = flux * scale
-                units = tmp[1]
-            except ValueError:
-                raise ValueError("Non-numeric units scale factor {}".format(tmp[0]))
+        dw = _bin_width(wavelength)
 
-        #- Default exposure time
-        if exptime is None:
-            exptime = self.exptime
+        scale, is_erg, per_angstrom = self._photon_scale(units, exptime)
 
         #- Input photons; return photons per bin (not photons per Angstrom)
-        if units == "photon":
-            return flux
-        elif units == "photon/A":
-            return flux * dw
-
-        #- Sanity check on units
-        if not units.startswith('erg'):
+        if not is_erg:
+            if scale != 1.0:
+                flux = flux * scale
+            if per_angstrom:
+                return flux * dw
+            else:
+                return flux
+
+        #- If we got here, we need to apply throughputs and convert to photons
+        if isinstance(objtype, str):
+            thru = self.thru(wavelength, objtype=objtype, airmass=airmass,
+                             binned=binned)
+
+            #- Common case: single spectrum; one pass without temporaries.
+            #- numba doesn't bounds check, so only use it for plain arrays
+            #- matching the wavelength grid; otherwise broadcast below
+            if type(flux) is np.ndarray and flux.shape == dw.shape:
+                return _erg_to_photons(np.asarray(flux, dtype=np.float64),
+                    np.asarray(thru, dtype=np.float64),
+                    np.asarray(wavelength, dtype=np.float64),
+                    np.asarray(dw, dtype=np.float64), scale, per_angstrom)
+
+            #- Many spectra on the same grid (or masked arrays): build the
+            #- per-wavelength conversion once and broadcast it over flux
+            factor = thru * wavelength
+            factor *= scale
+            if per_angstrom:
+                factor *= dw
+
+            return flux * factor
+
+        #- phot is a new float array after the first multiply (keeping any
+        #- mask), so scale it in place
+        phot = self.apply_throughput(wavelength, flux,
+                                 objtype=objtype, airmass=airmass,
+                                 binned=binned)
+        phot = phot * wavelength
+        phot *= scale
+        if per_angstrom:
+            phot *= dw
+
+        return phot
+
+    def _photon_scale(self, units, exptime=None):
+        """
+        Returns scale, is_erg, per_angstrom for flux `units`, where scale
+        is the scalar factor converting flux to photons (excluding
+        throughput, wavelength, and bin width terms), is_erg is True if the
+        units are erg-based and per_angstrom is True if the units must be
+        multiplied by the wavelength bin width.
+        """
+        #- Standardize units; allow some sloppiness
+        scale, units = _standardize_units(units)
+        if units not in _UNIT_CODES:
             raise ValueError("Unrecognized units {}".format(units))
 
-        #- If we got here, we need to apply throughputs
-        flux = self.apply_throughput(wavelength, flux,
-                                 objtype=objtype, airmass=airmass)
-
-        #- Convert to photons
-        phot = flux * wavelength / self._hc
+        is_erg, per_angstrom, per_arcsec2 = _UNIT_CODES[units]
 
-        #- erg/s/cm^2/A (i.e. Flambda, astronomical object)
-        if units == "erg/s/cm^2/A":
-            return phot * exptime * self.area * dw
+        if is_erg:
+            #- Default exposure time
+            if exptime is None:
+                exptime = self.exptime
 
-        #- erg/s/cm^2/A/arcsec^2 (e.g. sky)
-        elif units == "erg/s/cm^2/A/arcsec^2":
-            return phot * exptime * self.area * dw * self.fiberarea
+            scale *= exptime * self.area * self._inv_hc
+            if per_arcsec2:
+                scale *= self._fiberarea
 
-        #- erg/s/cm^2 (not per A; flux delta functions at given wavelengths)
-        elif units == "erg/s/cm^2":
-            return phot * exptime * self.area
+        return scale, is_erg, per_angstrom
 
-        #- erg/s/cm^2/arcsec^2 (not per A; intensity delta functions)
-        elif units == "erg/s/cm^2/arcsec^2":
-            return phot * exptime * self.area * self.fiberarea
-
-        else:
-            raise ValueError("Unrecognized units {}".format(units))
-
-    def apply_throughput(self, wavelength, flux, objtype="STAR", airmass=1.0):
+    def photons_specialized(self, units="erg/s/cm^2/A", objtype="STAR",
+                            exptime=None, airmass=1.0, binned=False):
+        """
+        Returns function f(wavelength, flux) equivalent to
+        self.photons(wavelength, flux, units, objtype, exptime, airmass, binned)
+        for repeated calls with the same arguments.
+
+        Units parsing is done once here, and the per-wavelength conversion
+        factor is cached for the most recent wavelength grid, so that
+        repeated calls on the same grid reduce to a single multiply.
+        Changes to this Throughput object after this call, e.g. to
+        exptime, are not reflected in the returned function.
+        """
+        scale, is_erg, per_angstrom = self._photon_scale(units, exptime)
+        cache = dict(wavelength=None, factor=None)
+
+        def photons(wavelength, flux):
+            w = cache['wavelength']
+            if w is None or w.shape != np.shape(wavelength) or \
+                    not np.array_equal(w, wavelength):
+                wavelength = np.array(wavelength, dtype=np.float64)
+                if is_erg:
+                    factor = self.thru(wavelength, objtype=objtype,
+                                       airmass=airmass, binned=binned)
+                    factor = factor * wavelength
+                    factor *= scale
+                else:
+                    factor = np.full(wavelength.shape, scale)
+                if per_angstrom:
+                    factor *= _bin_width(wavelength)
+
+                cache['wavelength'] = wavelength
+                cache['factor'] = factor
+
+            return flux * cache['factor']
+
+        return photons
+
+    def apply_throughput(self, wavelength, flux, objtype="STAR", airmass=1.0,
+                         binned=False):
         """
         Returns flux array with throughputs applied for given
         objtype and airmass.
 
-        TODO: this is a simple throughput model that can be wrong if there
-        is meaningful structure smaller than the wavelength sampling.
+        By default the throughput is sampled at each wavelength, which can be
+        wrong if there is meaningful structure smaller than the wavelength
+        sampling; use binned=True to apply the throughput averaged over
+        each wavelength bin instead.
         """
 
         if flux.ndim == 1 or isinstance(objtype, str):
-            thru = self.thru(wavelength, objtype=objtype, airmass=airmass)
+            thru = self.thru(wavelength, objtype=objtype, airmass=airmass,
+                             binned=binned)
             return flux * thru
         else:
             assert flux.ndim == 2
             assert flux.shape[0] == len(objtype)
 
-            t = dict()
             objtype = np.array(objtype)
-            outflux = flux.copy()
+            #- float output even for integer flux
+            outflux = np.empty_like(flux, dtype=np.result_type(flux, self._thru))
             for xt in set(objtype):
-                thru = self.thru(wavelength, objtype=xt, airmass=airmass)
+                thru = self.thru(wavelength, objtype=xt, airmass=airmass,
+                                 binned=binned)
                 ii = np.where(objtype == xt)[0]
-                outflux[ii] *= thru
+                outflux[ii] = flux[ii] * thru
 
             return outflux
 